@@ -9,6 +9,7 @@ import requests
 import sys
 
 import lol.model as model
+import lol.trace as trace
 
 @enum.unique
 class status(enum.IntEnum):
@@ -25,17 +26,26 @@ class RiotRequest(object):
     def get(cls, key, **kwargs):
         '''Calls the Riot API and processes result.'''
         constructed_url = cls.base_url + cls.path.format(**kwargs)
+        params = cls._params(**kwargs)
+        params['api_key'] = key
         try:
-            result = requests.get(constructed_url, params={'api_key': key})
+            with trace.span('request'):
+                result = requests.get(constructed_url, params=params)
         except:
             logging.warning('%s', sys.exc_info())
             return (status.failed_request, None)
         try:
             assert result.status_code == 200
-            return (status.ok, cls._parse(result.json(), **kwargs))
+            with trace.span('parse'):
+                return (status.ok, cls._parse(result.json(), **kwargs))
         except:
             return (status.malformed_request, None)
 
+    @classmethod
+    def _params(cls, **kwargs):
+        '''Returns the query parameters of the call, excluding the key.'''
+        return {}
+
     @classmethod
     def _parse(cls, json, **kwargs):
         '''Processes the JSON request result, if successful.'''
@@ -43,22 +53,38 @@ class RiotRequest(object):
 
 
 class MatchList(RiotRequest):
-    '''Returns all SoloqQ matches of a summoner in the current season.'''
+    '''Returns all SoloqQ matches of a summoner in the current season. If
+    begin_time is set, only returns the matches created after it.
+    '''
 
     path = '/api/lol/{region}/v2.2/matchlist/by-summoner/{summoner_id:d}'
 
     @classmethod
-    def get(cls, key, summoner_id):
-        return super().get(key, region=model.current_region, summoner_id=summoner_id)
+    def get(cls, key, summoner_id, begin_time=None):
+        return super().get(key, region=model.current_region, summoner_id=summoner_id,
+                begin_time=begin_time)
 
     @classmethod
-    def _parse(cls, j_data, region='', summoner_id=0):
-        j_matches = j_data['matches']
+    def _params(cls, region='', summoner_id=0, begin_time=None):
+        if begin_time is None:
+            return {}
+        # Let the server drop the games we have already seen.
+        return {
+            'beginTime': begin_time + 1,
+            'rankedQueues': model.ranked_solo,
+            'seasons': model.current_season,
+        }
+
+    @classmethod
+    def _parse(cls, j_data, region='', summoner_id=0, begin_time=None):
+        # An empty match list has no 'matches' field.
+        j_matches = j_data.get('matches', [])
         matches = []
         for j_match in j_matches:
             if j_match['season'] == model.current_season \
                     and j_match['queue'] == model.ranked_solo:
-                matches.append(model.match_champion(j_match['matchId'], j_match['champion']))
+                matches.append(model.match_champion(j_match['matchId'],
+                    j_match['champion'], j_match['timestamp']))
         return matches
 
 
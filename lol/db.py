@@ -6,12 +6,17 @@ __doc__ = '''Database-specific logic here. All functions are thread-safe.
 import threading
 import lol.model as model
 import lol.config as config
+import lol.trace as trace
 
 
 def with_lock(f):
     def g(*args, **kwargs):
-        with _lock:
-            f(*args, **kwargs)
+        with trace.span('db_lock'):
+            _lock.acquire()
+        try:
+            return f(*args, **kwargs)
+        finally:
+            _lock.release()
     return g
 
 
@@ -33,6 +38,39 @@ def add_summoner_champions(champions):
             'expected Champion objects.'
 
 
+@with_lock
+def add_summoner_crawl(summoner_id, crawl_time, match_times):
+    '''Records a crawl of a summoner at crawl_time that found new matches
+    created at match_times. Times are in milliseconds since the epoch.
+
+    The summoner's activity is the number of new matches per hour since the
+    previous crawl, or since the first match found on the first crawl.
+    '''
+    last = _summoner_last_match.get(summoner_id, 0)
+    _summoner_last_match[summoner_id] = max([last] + match_times)
+
+    since = _summoner_crawl_time.get(summoner_id, min(match_times, default=crawl_time))
+    hours = (crawl_time - since) / (60*60*1000)
+    _summoner_activity[summoner_id] = len(match_times) / hours if hours > 0 else 0
+    _summoner_crawl_time[summoner_id] = crawl_time
+
+
+@with_lock
+def get_summoner_last_match(summoner_id):
+    '''Returns the creation time of the summoner's most recent match, or None
+    if the summoner has not been crawled.
+    '''
+    return _summoner_last_match.get(summoner_id)
+
+
+@with_lock
+def get_recrawl_summoner_ids(limit=None):
+    '''Returns the crawled summoner ids, most matches per hour first.'''
+    summoner_ids = sorted(_summoner_last_match, key=lambda x:
+            (_summoner_activity[x], _summoner_last_match[x]), reverse=True)
+    return summoner_ids[:limit]
+
+
 @with_lock
 def has_summoner_id(summoner_id):
     return summoner_id in _summoner_ids
@@ -47,3 +85,6 @@ def has_match_id(match_id):
 _lock = threading.Lock()
 _match_ids = set()
 _summoner_ids = set()
+_summoner_last_match = {}
+_summoner_activity = {}
+_summoner_crawl_time = {}
@@ -41,7 +41,7 @@ _map_tier_id = {
 }
 
 
-match_champion = namedtuple('MatchChampion', ['match_id', 'champion_id'])
+match_champion = namedtuple('MatchChampion', ['match_id', 'champion_id', 'timestamp'])
 
 
 class Match(object):
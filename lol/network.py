@@ -4,12 +4,15 @@ __doc__ = '''Multithreaded and thread-safe components.
 
 
 import collections
-import concurrent.futures
 import enum
+import logging
 import math
+import sys
 import threading
 import time
 
+import lol.trace as trace
+
 
 @enum.unique
 class queue_status(enum.IntEnum):
@@ -23,7 +26,7 @@ class APITaskQueue(object):
     '''Rate-limited multi-threaded API task queue.'''
 
     def __init__(self, api_keys=[], rate_limits=[], queue_limit=None,
-            num_threads=1):
+            min_threads=1, max_threads=None, wait_timeout=1):
         '''Args:
             api_keys: if this is set, a key will be passed onto the task as a
                 param.
@@ -31,7 +34,12 @@ class APITaskQueue(object):
                 send a max of num_requests within num_seconds for each key.
             queue_limit: maximum number of tasks we should enqueue. Default to
                 unlimited.
-            num_threads: number of threads to use. Default to 1.
+            min_threads: minimum number of threads to use. Default to 1.
+            max_threads: maximum number of threads to use. Between the two, the
+                pool is sized from the task latency and the rate limits.
+                Default to min_threads.
+            wait_timeout: number of seconds an idle thread waits for a task
+                before checking whether it should stop. Default to 1.
         '''
         assert all((len(x) == 2 and x[0] > 0 and x[1] > 0) for x in rate_limits), \
                 'rate limits must be of type (num_requests, num_seconds).'
@@ -44,7 +52,8 @@ class APITaskQueue(object):
 
         self._queue = TaskQueue(rate_limits=rate_limits, queue_limit=queue_limit)
         self._thread_pool = FunctionalThreadPool(self._check_and_run,
-                num_threads=num_threads)
+                min_threads=min_threads, max_threads=max_threads,
+                rate_fn=self._queue.rate_headroom)
 
         self._api_keys = api_keys
         self._need_key = len(api_keys) > 0
@@ -52,27 +61,74 @@ class APITaskQueue(object):
             self._key_counter = 0
             self._key_lock = threading.Lock()
         self._cv = threading.Condition()
+        self._wait_timeout = wait_timeout
+        self._peek_thread = PeekQueueThread(self._queue, self._cv)
+        self._periodic_threads = []
 
     def put(self, tasks):
         '''Adds tasks to the queue. Thread-safe.'''
+        trace.enqueued(tasks)
         return self._queue.put(tasks)
 
     def start(self):
         '''Activates the scheduler. Queue should be seeded before running this.
         '''
-        PeekQueueThread(self._queue, self._cv).start()
+        self._peek_thread.start()
         self._thread_pool.start()
 
+    def schedule(self, fn, interval):
+        '''Runs fn every interval seconds until the scheduler is stopped or
+        drained, and returns the thread running it.
+        '''
+        thread = PeriodicThread(fn, interval)
+        self._periodic_threads.append(thread)
+        thread.start()
+        return thread
+
+    def stop(self):
+        '''Stops the scheduler once the running tasks finish. Queued tasks are
+        not run.
+        '''
+        self._stop_periodic_threads()
+        self._thread_pool.stop()
+        self._peek_thread.stop()
+
+    def drain(self):
+        '''Stops the scheduler once the queue is empty.'''
+        self._stop_periodic_threads()
+        self._thread_pool.drain()
+
+    def join(self):
+        '''Waits for the scheduler to stop.'''
+        self._thread_pool.join()
+        self._stop_periodic_threads()
+        for thread in self._periodic_threads:
+            thread.join()
+        self._peek_thread.stop()
+        self._peek_thread.join()
+
+    def _stop_periodic_threads(self):
+        for thread in self._periodic_threads:
+            thread.stop()
+
     def _check_and_run(self):
+        '''Runs a task, and returns False iff there was nothing to run.'''
+        wait_start = time.time()
         with self._cv:
-            task = self._cv.wait_for(self._queue.get)
-        if self._need_key:
-            with self._key_lock:
-                key = self._api_keys[self._key_counter]
-                self._key_counter = (self._key_counter + 1) % len(self._api_keys)
-            task(key=key)
-        else:
-            task()
+            task = self._cv.wait_for(self._queue.get, timeout=self._wait_timeout)
+        if task is None:
+            return self._queue.status()[0] is not queue_status.empty
+        start = time.time()
+        with trace.running(task, wait_start):
+            if self._need_key:
+                with self._key_lock:
+                    key = self._api_keys[self._key_counter]
+                    self._key_counter = (self._key_counter + 1) % len(self._api_keys)
+                task(key=key)
+            else:
+                task()
+        self._thread_pool.record_latency(time.time() - start)
+        return True
 
 
 class PeekQueueThread(threading.Thread):
@@ -83,19 +139,45 @@ class PeekQueueThread(threading.Thread):
         self._queue = queue
         self._notify_cv = notify_cv
         self._sleep_duration = sleep_duration
+        self._stopped = threading.Event()
 
     def run(self):
         '''Override.'''
-        while True:
+        while not self._stopped.is_set():
             status = self._queue.status()
             if status[0] is queue_status.available:
                 with self._notify_cv:
                     self._notify_cv.notify_all()
-                time.sleep(self._sleep_duration)
+                self._stopped.wait(self._sleep_duration)
             elif status[0] is queue_status.unavailable:
-                time.sleep(status[1])
+                self._stopped.wait(status[1])
             else:
-                time.sleep(self._sleep_duration)
+                self._stopped.wait(self._sleep_duration)
+
+    def stop(self):
+        '''Stops the thread after its current check.'''
+        self._stopped.set()
+
+
+class PeriodicThread(threading.Thread):
+    '''Thread that runs a function every interval seconds.'''
+
+    def __init__(self, fn, interval):
+        super().__init__()
+        assert callable(fn), 'function must be callable.'
+        assert interval > 0, 'interval must be positive.'
+        self._fn = fn
+        self._interval = interval
+        self._stopped = threading.Event()
+
+    def run(self):
+        '''Override.'''
+        while not self._stopped.wait(self._interval):
+            self._fn()
+
+    def stop(self):
+        '''Stops the thread after its current run of fn.'''
+        self._stopped.set()
 
 
 class TaskQueue(object):
@@ -114,6 +196,8 @@ class TaskQueue(object):
         self._queue_limit = queue_limit
         self._rate_counters = RateCounterPool(rate_limits)
         self._lock = threading.Lock()
+        # When the rate limits started holding back the first task, if they are.
+        self._limited_since = None
 
     def put(self, tasks):
         '''Adds as many tasks as possible to the queue, and returns the number
@@ -139,12 +223,21 @@ class TaskQueue(object):
             elif len(self._queue) == 0:
                 return (queue_status.empty,)
             else:
+                self._mark_limited()
                 ttl = self._rate_counters.time_until_ready(now)
                 if ttl is None:
                     return (queue_status.not_started,)
                 else:
                     return (queue_status.unavailable, ttl)
 
+    def rate_headroom(self):
+        '''Returns the number of tasks per second the rate limits currently
+        allow. Thread-safe.
+        '''
+        with self._lock:
+            now = math.ceil(time.time())
+            return self._rate_counters.headroom(now)
+
     def get(self):
         '''Returns a task iff the caller can execute the task given the time
         limit, else returns None. Thread-safe.
@@ -154,7 +247,16 @@ class TaskQueue(object):
             if self._rate_counters.can_add(now) and len(self._queue) > 0:
                 self._rate_counters.increment(now)
                 task = self._queue.popleft()
+                if self._limited_since is not None:
+                    trace.rate_limited(task, self._limited_since)
+                    self._limited_since = None
                 return task
+            elif len(self._queue) > 0:
+                self._mark_limited()
+
+    def _mark_limited(self):
+        if self._limited_since is None:
+            self._limited_since = time.time()
 
 
 class RateCounterPool(object):
@@ -181,6 +283,13 @@ class RateCounterPool(object):
         ready = max(x.time_until_ready(now) for x in self._rate_counters)
         return ready if ready > 0 else None
 
+    def headroom(self, now):
+        '''Returns the number of tasks per second that can be run until the
+        most restrictive rate limit resets.
+        '''
+        return min((x.headroom(now) for x in self._rate_counters),
+                default=math.inf)
+
     def increment(self, now):
         '''Automatically starts the timer, and adds 1 to the counters.'''
         for x in self._rate_counters:
@@ -214,6 +323,19 @@ class RateCounter(object):
             return -1
         return self._interval - (now - self._start)
 
+    def headroom(self, now):
+        '''Returns the number of tasks per second that can be run until the
+        limit resets. Never less than the long-run rate of limit/interval.
+        '''
+        self._maybe_reset(now)
+        steady = self._limit / self._interval
+        if self._start is None:
+            return steady
+        remaining = self._interval - (now - self._start)
+        if remaining <= 0:
+            return steady
+        return max(steady, (self._limit - self._count) / remaining)
+
     def increment(self, now):
         '''Automatically starts the timer, and assumes a task will be run soon.
         '''
@@ -230,28 +352,134 @@ class RateCounter(object):
 
 class FunctionalThreadPool(object):
     '''A thread pool that will repeatedly run the same function from multiple
-    threads.
+    threads. The pool is resized between min_threads and max_threads so that,
+    by Little's law, it has just enough threads to run fn at the rate allowed
+    by rate_fn given the observed latency of fn.
     '''
 
-    def __init__(self, fn, num_threads=1):
+    def __init__(self, fn, min_threads=1, max_threads=None, rate_fn=None,
+            resize_interval=5, smoothing=0.2):
         '''Args:
-            num_threads: number of threads to use. Default to 1.
+            fn: function to run. Should return False iff there was nothing to
+                do, which lets drain() stop the thread.
+            min_threads: minimum number of threads to use. Default to 1.
+            max_threads: maximum number of threads to use. Default to
+                min_threads.
+            rate_fn: returns the number of calls of fn per second currently
+                allowed. Required to resize the pool.
+            resize_interval: number of seconds between resizes.
+            smoothing: weight of the newest latency sample in the latency
+                moving average.
         '''
-        assert num_threads > 0, \
+        if max_threads is None:
+            max_threads = min_threads
+        assert min_threads > 0, \
                 'Must have at least 1 thread for the Scheduler to run.'
+        assert max_threads >= min_threads, \
+                'max_threads must be at least min_threads.'
         assert callable(fn), 'function must be callable.'
+        assert rate_fn is None or callable(rate_fn), \
+                'rate function must be callable.'
         self._fn = fn
-        self._num_threads = num_threads
+        self._min_threads = min_threads
+        self._max_threads = max_threads
+        self._rate_fn = rate_fn
+        self._resize_interval = resize_interval
+        self._smoothing = smoothing
+
+        self._lock = threading.Lock()
+        self._threads = []
+        self._num_threads = 0
+        self._target = min_threads
+        self._latency = None
+        self._draining = False
+        self._stopped = threading.Event()
 
     def start(self):
-        '''Starts running the thread pool.'''
-        def run_forever(f):
-            def g():
-                while True:
-                    f()
-            return g
-
-        with concurrent.futures.ThreadPoolExecutor(max_workers=self._num_threads) as executor:
-            futures = [executor.submit(run_forever(self._fn))
-                    for _ in range(self._num_threads)]
-            concurrent.futures.as_completed(futures)
+        '''Starts running the thread pool. Does not block.'''
+        with self._lock:
+            self._spawn(self._target)
+        if self._rate_fn is not None and self._max_threads > self._min_threads:
+            resizer = threading.Thread(target=self._resize_forever)
+            resizer.start()
+            with self._lock:
+                self._threads.append(resizer)
+
+    def stop(self):
+        '''Stops every thread once its current call of fn returns.'''
+        self._stopped.set()
+
+    def drain(self):
+        '''Stops every thread once fn has nothing to do.'''
+        with self._lock:
+            self._draining = True
+
+    def join(self):
+        '''Waits for every thread to stop.'''
+        while True:
+            with self._lock:
+                threads = [x for x in self._threads if x.is_alive()]
+            if not threads:
+                return
+            for thread in threads:
+                thread.join()
+
+    def size(self):
+        '''Returns the current number of threads.'''
+        with self._lock:
+            return self._num_threads
+
+    def record_latency(self, seconds):
+        '''Adds a sample of how long a call of fn was busy.'''
+        with self._lock:
+            if self._latency is None:
+                self._latency = seconds
+            else:
+                self._latency += self._smoothing * (seconds - self._latency)
+
+    def _run(self):
+        try:
+            while True:
+                # Decide to exit and leave the count in one step, so that
+                # shrinking can't retire more threads than needed.
+                with self._lock:
+                    if self._stopped.is_set() or self._num_threads > self._target:
+                        self._num_threads -= 1
+                        return
+                try:
+                    did_work = self._fn()
+                except Exception:
+                    logging.warning('%s', sys.exc_info())
+                    continue
+                if not did_work:
+                    with self._lock:
+                        if self._draining:
+                            self._num_threads -= 1
+                            return
+        except:
+            with self._lock:
+                self._num_threads -= 1
+            raise
+
+    def _resize_forever(self):
+        while not self._stopped.wait(self._resize_interval):
+            with self._lock:
+                if self._draining:
+                    return
+                if self._latency is None:
+                    continue
+                latency = self._latency
+            target = math.ceil(self._rate_fn() * latency)
+            target = min(max(target, self._min_threads), self._max_threads)
+            with self._lock:
+                self._target = target
+                self._spawn(target - self._num_threads)
+
+    def _spawn(self, n):
+        '''Starts n more threads. Must hold the lock.'''
+        self._threads = [x for x in self._threads if x.is_alive()]
+        for _ in range(n):
+            thread = threading.Thread(target=self._run)
+            thread.start()
+            self._threads.append(thread)
+            self._num_threads += 1
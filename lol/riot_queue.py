@@ -8,16 +8,33 @@ import lol.network as network
 
 
 def add_task(t):
-    _riot_queue.put([t])
+    return _riot_queue.put([t])
 
 
 def add_tasks(ts):
-    _riot_queue.put(ts)
+    return _riot_queue.put(ts)
 
 
 def start():
     _riot_queue.start()
 
 
+def schedule(fn, interval):
+    return _riot_queue.schedule(fn, interval)
+
+
+def stop():
+    _riot_queue.stop()
+
+
+def drain():
+    _riot_queue.drain()
+
+
+def join():
+    _riot_queue.join()
+
+
 _riot_queue = network.APITaskQueue(api_keys=config.API_KEYS,
-        rate_limits=[(5, 10), (250, 10*60)], queue_limit=1000, num_threads=30)
+        rate_limits=[(5, 10), (250, 10*60)], queue_limit=1000, min_threads=2,
+        max_threads=30)
@@ -7,6 +7,7 @@ import lol.api as api
 import lol.db as db
 import lol.model as model
 import lol.riot_queue as queue
+import time
 
 from collections import defaultdict
 
@@ -29,7 +30,7 @@ class MatchList(Task):
         self._summoner_id = summoner_id
 
     def __call__(self, key=''):
-        if db.has_summoner_id(self._summoner_id):
+        if db.get_summoner_last_match(self._summoner_id) is not None:
             return False
 
         match_list = self._handle_response(api.MatchList.get(key, self._summoner_id))
@@ -38,11 +39,16 @@ class MatchList(Task):
 
         summoner_champions = self._get_summoner_champions(match_list)
         db.add_summoner_champions(summoner_champions)
+        self._add_matches(match_list)
+        return True
+
+    def _add_matches(self, match_list):
+        db.add_summoner_crawl(self._summoner_id, int(time.time() * 1000),
+                [x.timestamp for x in match_list])
 
         match_ids = [x.match_id for x in match_list \
                 if not db.has_match_id(x.match_id)]
         queue.add_tasks([MatchInfo(x) for x in match_ids])
-        return True
 
     def _get_summoner_champions(self, match_list):
         champ_counts = defaultdict(int)
@@ -54,6 +60,42 @@ class MatchList(Task):
         return z
 
 
+class MatchListUpdate(MatchList):
+    '''Pulls the matches a crawled player has played since the last crawl and
+    enqueues them.
+    '''
+
+    def __call__(self, key=''):
+        last_match = db.get_summoner_last_match(self._summoner_id)
+        if last_match is None:
+            return False
+
+        match_list = self._handle_response(api.MatchList.get(key, self._summoner_id,
+            begin_time=last_match))
+        if match_list is None:
+            return False
+
+        summoner_champions = self._get_summoner_champions(match_list)
+        db.add_summoner_champions(summoner_champions)
+        self._add_matches(match_list)
+        return True
+
+
+def recrawl(limit=None):
+    '''Enqueues an update of the most active crawled summoners, and returns the
+    number of summoners enqueued.
+    '''
+    summoner_ids = db.get_recrawl_summoner_ids(limit)
+    return queue.add_tasks([MatchListUpdate(x) for x in summoner_ids])
+
+
+def start_recrawl(interval=60*60, limit=500):
+    '''Runs recrawl every interval seconds until the queue is stopped or
+    drained, and returns the thread running it.
+    '''
+    return queue.schedule(lambda: recrawl(limit), interval)
+
+
 class SummonerTier(Task):
     '''Adds a summoner and her tier.'''
 
@@ -5,7 +5,8 @@ import time
 
 
 s = APITaskQueue(api_keys=['shine', 'simon', 'bryan', 'shine2', 'shine3', 'shine4'],
-        rate_limits=[(10, 10), (500, 10*60)], queue_limit=1000, num_threads=60)
+        rate_limits=[(10, 10), (500, 10*60)], queue_limit=1000, min_threads=1,
+        max_threads=60)
 
 class Counter(object):
     def __init__(self):
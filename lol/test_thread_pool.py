@@ -0,0 +1,59 @@
+from lol.network import FunctionalThreadPool
+import threading
+import time
+
+
+def wait_until(condition, timeout=10):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline, 'timed out.'
+        time.sleep(0.01)
+
+
+latency = 0.05
+rate = [500]
+# Unlimited work until the resize checks are done.
+work = [None]
+lock = threading.Lock()
+
+def f():
+    with lock:
+        if work[0] == 0:
+            return False
+        if work[0] is not None:
+            work[0] -= 1
+    time.sleep(latency)
+    pool.record_latency(latency)
+    return True
+
+pool = FunctionalThreadPool(f, min_threads=1, max_threads=8,
+        rate_fn=lambda: rate[0], resize_interval=0.05)
+pool.start()
+
+# ceil(500 * 0.05) = 25 is clamped to max_threads.
+wait_until(lambda: pool.size() == 8)
+
+# ceil(40 * 0.05) = 2.
+rate[0] = 40
+wait_until(lambda: pool.size() == 2)
+
+with lock:
+    work[0] = 20
+pool.drain()
+pool.join()
+assert work[0] == 0
+assert pool.size() == 0
+
+
+def g():
+    time.sleep(0.01)
+    raise ValueError('bad task')
+
+pool = FunctionalThreadPool(g, min_threads=2)
+pool.start()
+time.sleep(0.1)
+assert pool.size() == 2, 'workers should survive exceptions.'
+pool.stop()
+pool.join()
+assert pool.size() == 0
+print('OK')
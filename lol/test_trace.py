@@ -0,0 +1,61 @@
+import lol.trace as trace
+from lol.network import APITaskQueue
+import json
+import threading
+
+
+b = trace._RingBuffer(threading.current_thread(), 3)
+assert b.records() == []
+for i in range(2):
+    b.add(i)
+assert b.records() == [0, 1]
+for i in range(2, 7):
+    b.add(i)
+assert b.records() == [4, 5, 6], b.records()
+
+
+trace.enable(sample_rate=1)
+s = APITaskQueue(rate_limits=[(100, 1)], min_threads=2)
+
+class Child(object):
+    def __call__(self):
+        with trace.span('parse'):
+            pass
+
+class Parent(object):
+    def __call__(self):
+        with trace.span('request'):
+            s.put([Child(), Child()])
+
+parent = Parent()
+s.put([parent])
+s.start()
+s.drain()
+s.join()
+
+records = trace.records()
+parent_id = parent._trace.task_id
+assert parent._trace.parent_id is None
+child_ids = {x.task_id for x in records if x.stack[0] == 'Child'}
+assert len(child_ids) == 2
+assert all(x.parent_id == parent_id for x in records if x.stack[0] == 'Child')
+assert ('Parent', 'request') in {x.stack for x in records}
+assert ('Child', 'parse') in {x.stack for x in records}
+
+events = json.loads(json.dumps(trace.chrome_trace()))['traceEvents']
+assert {x['ph'] for x in events} == {'X', 'b', 'e'}
+assert all({'name', 'cat', 'ph', 'ts', 'pid', 'tid', 'args'} <= set(x)
+        for x in events)
+assert all('dur' in x for x in events if x['ph'] == 'X')
+assert sum(x['ph'] == 'b' for x in events) == sum(x['ph'] == 'e' for x in events)
+
+stacks = dict(x.rsplit(' ', 1) for x in trace.collapsed_stacks())
+assert {'Parent', 'Parent;request', 'Parent;queued', 'Child', 'Child;parse',
+        'worker;idle'} <= set(stacks), stacks
+assert not any(x.startswith(('Parent;', 'Child;')) and x.endswith('idle')
+        for x in stacks)
+assert all(int(x) >= 0 for x in stacks.values())
+trace.disable()
+s.put([parent])
+assert parent._trace is None
+print('OK')
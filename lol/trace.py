@@ -0,0 +1,263 @@
+__doc__ = '''Opt-in sampled tracing of the stages of a task. Spans are kept in a
+per-thread ring buffer, and can be exported as Chrome Trace Event JSON or as
+collapsed stacks for flamegraphs.
+
+'''
+
+
+import collections
+import itertools
+import json
+import os
+import random
+import threading
+import time
+
+
+span_record = collections.namedtuple('SpanRecord', ['stack', 'task_id',
+    'parent_id', 'thread_id', 'start', 'duration', 'self_duration'])
+
+task_context = collections.namedtuple('TaskContext', ['task_id', 'parent_id',
+    'enqueue_time', 'sampled', 'rate_limit_time'])
+
+
+def enable(sample_rate=0.01, buffer_size=10000):
+    '''Starts tracing tasks enqueued from now on.
+
+    Args:
+        sample_rate: fraction of the tasks to trace.
+        buffer_size: maximum number of spans to keep per live thread.
+    '''
+    assert 0 <= sample_rate <= 1, 'sample rate must be within [0, 1].'
+    assert buffer_size > 0, 'buffer size must be positive.'
+    global _enabled, _sample_rate, _buffer_size
+    _sample_rate = sample_rate
+    _buffer_size = buffer_size
+    _enabled = True
+
+
+def disable():
+    '''Stops tracing newly enqueued tasks. Recorded spans are kept.'''
+    global _enabled
+    _enabled = False
+
+
+def enqueued(tasks):
+    '''Tags tasks with their id, parent and sampling decision, or untags them
+    if tracing is disabled. Call when the tasks are put in the queue.
+    '''
+    now = time.time()
+    current = getattr(_local, 'current', None)
+    parent_id = current.task_id if current is not None else None
+    for task in tasks:
+        try:
+            if _enabled:
+                task._trace = task_context(next(_task_ids), parent_id, now,
+                        random.random() < _sample_rate, None)
+            else:
+                task._trace = None
+        except AttributeError:
+            pass
+
+
+def rate_limited(task, since):
+    '''Records that the rate limits held back task at the front of the queue
+    from since until now.
+    '''
+    context = getattr(task, '_trace', None)
+    if context is not None and context.sampled:
+        task._trace = context._replace(rate_limit_time=since)
+
+
+class running(object):
+    '''Context manager around the call of a task. Records the time the task
+    spent queued and the time it was held back by the rate limits. The time
+    the worker was idle since wait_start is recorded apart from the task's
+    stages, as it overlaps them.
+    '''
+
+    def __init__(self, task, wait_start):
+        self._context = getattr(task, '_trace', None)
+        self._name = getattr(task, '__name__', type(task).__name__)
+        self._wait_start = wait_start
+
+    def __enter__(self):
+        context = self._context
+        if context is None:
+            return self
+        _local.current = context
+        if not context.sampled:
+            return self
+        now = time.time()
+        limited = context.rate_limit_time
+        if limited is None:
+            _record((self._name, 'queued'), context.enqueue_time, now, 0)
+        else:
+            limited = max(limited, context.enqueue_time)
+            _record((self._name, 'queued'), context.enqueue_time, limited, 0)
+            _record((self._name, 'rate_limit'), limited, now, 0)
+        _record(('worker', 'idle'), self._wait_start, now, 0)
+        _local.stack = [[self._name, now, 0]]
+        return self
+
+    def __exit__(self, *exc_info):
+        if self._context is None:
+            return False
+        if self._context.sampled:
+            (name, start, children) = _local.stack.pop()
+            _record((name,), start, time.time(), children)
+        _local.current = None
+        return False
+
+
+def span(name):
+    '''Returns a context manager that records a span named name as a stage of
+    the running task, if it is being traced.
+    '''
+    current = getattr(_local, 'current', None)
+    if current is None or not current.sampled:
+        return _null_span
+    return _Span(name)
+
+
+class _Span(object):
+
+    def __init__(self, name):
+        self._name = name
+
+    def __enter__(self):
+        _local.stack.append([self._name, time.time(), 0])
+        return self
+
+    def __exit__(self, *exc_info):
+        stack = _local.stack
+        (_, start, children) = stack.pop()
+        end = time.time()
+        stack[-1][2] += end - start
+        _record(tuple(x[0] for x in stack) + (self._name,), start, end,
+                children)
+        return False
+
+
+class _NullSpan(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+class _RingBuffer(object):
+    '''Keeps the latest spans of one thread. Only the owning thread writes to
+    it, so adding needs no lock; readers may miss the newest spans. Once the
+    owner exits, the buffer is handed to the next thread that needs one.
+    '''
+
+    def __init__(self, thread, size):
+        self.thread = thread
+        self._records = [None] * size
+        self._next = 0
+
+    def add(self, record):
+        self._records[self._next % len(self._records)] = record
+        self._next += 1
+
+    def records(self):
+        n = self._next
+        size = len(self._records)
+        if n <= size:
+            return self._records[:n]
+        i = n % size
+        return self._records[i:] + self._records[:i]
+
+
+def _record(stack, start, end, children):
+    buffer = getattr(_local, 'buffer', None)
+    if buffer is None:
+        buffer = _claim_buffer()
+        _local.buffer = buffer
+    context = _local.current
+    duration = end - start
+    buffer.add(span_record(stack, context.task_id, context.parent_id,
+        threading.get_ident(), start, duration, duration - children))
+
+
+def _claim_buffer():
+    '''Returns the buffer of an exited thread, or a new one if every owner is
+    alive, so the number of buffers is bounded by the peak number of traced
+    threads. Runs once per thread.
+    '''
+    thread = threading.current_thread()
+    with _buffers_lock:
+        for buffer in _buffers:
+            if not buffer.thread.is_alive():
+                buffer.thread = thread
+                return buffer
+        buffer = _RingBuffer(thread, _buffer_size)
+        _buffers.append(buffer)
+        return buffer
+
+
+def records():
+    '''Returns all the recorded spans.'''
+    return [x for buffer in list(_buffers) for x in buffer.records()
+            if x is not None]
+
+
+def chrome_trace():
+    '''Returns the recorded spans in the Chrome Trace Event format. Time spent
+    queued or rate limited is shown as an async event, since no thread owns
+    the task then.
+    '''
+    pid = os.getpid()
+    events = []
+    for record in records():
+        ts = record.start * 1e6
+        args = {'task_id': record.task_id, 'parent_id': record.parent_id}
+        if record.stack[-1] in _async_stages:
+            event = {'name': record.stack[0] + ' ' + record.stack[-1],
+                    'cat': 'queue',
+                    'id': record.task_id, 'pid': pid, 'tid': record.thread_id,
+                    'args': args}
+            events.append(dict(event, ph='b', ts=ts))
+            events.append(dict(event, ph='e', ts=ts + record.duration * 1e6))
+        else:
+            events.append({'name': record.stack[-1], 'cat': record.stack[0],
+                'ph': 'X', 'ts': ts, 'dur': record.duration * 1e6, 'pid': pid,
+                'tid': record.thread_id, 'args': args})
+    return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+
+def collapsed_stacks():
+    '''Returns the recorded spans as collapsed stacks weighted by their self
+    time in microseconds, as expected by flamegraph.pl.
+    '''
+    weights = collections.defaultdict(int)
+    for record in records():
+        weights[';'.join(record.stack)] += record.self_duration * 1e6
+    return ['{} {:d}'.format(stack, round(weight))
+            for (stack, weight) in sorted(weights.items())]
+
+
+def write_chrome_trace(path):
+    '''Writes chrome_trace() to path, for chrome://tracing.'''
+    with open(path, 'w') as f:
+        json.dump(chrome_trace(), f)
+
+
+def write_collapsed_stacks(path):
+    '''Writes collapsed_stacks() to path.'''
+    with open(path, 'w') as f:
+        f.write('\n'.join(collapsed_stacks()) + '\n')
+
+
+_enabled = False
+_sample_rate = 0.01
+_buffer_size = 10000
+_task_ids = itertools.count(1)
+_local = threading.local()
+_buffers = []
+_buffers_lock = threading.Lock()
+_null_span = _NullSpan()
+_async_stages = ('queued', 'rate_limit')